@@ -2,6 +2,17 @@ import streamlit as st
 import cv2
 import numpy as np
 
+# --- 0. 共用的常數與運算資源 ---
+# Streamlit 每次互動都會從頭重跑整個腳本，這些也會跟著重建；建立成本很低，
+# 重點是不要在分析函式裡每次呼叫都重建 (真正重的運算靠下面的 st.cache_data)
+# 形態學用的 3x3 結構元素
+_K3 = np.ones((3, 3), np.uint8)
+# 繪圖用的字型與顏色 (BGR)
+_FONT = cv2.FONT_HERSHEY_SIMPLEX
+_RED, _GREEN, _CYAN = (0, 0, 255), (0, 255, 0), (255, 255, 0)
+# 工作解析度：長邊超過這個像素就先縮小 (模糊與閾值的尺寸是以像素調的，不要設得太小)
+_WORK_SIZE = 1280
+
 # --- 1. 介面設定 ---
 st.set_page_config(page_title="通用智慧數藥丸", layout="centered")
 st.markdown("""
@@ -24,17 +35,34 @@ with st.expander("📐 如果抓到背景，請調整視野範圍"):
     scope_size = st.slider("視野範圍 (0.5 = 只看畫面中間 50%)", 0.3, 0.9, 0.6)
 
 # --- 3. 核心邏輯：通用適應性演算法 ---
-def smart_analysis(img_buffer, scope):
-    # 1. 讀取
-    file_bytes = np.asarray(bytearray(img_buffer.read()), dtype=np.uint8)
-    img = cv2.imdecode(file_bytes, 1)
-    h, w = img.shape[:2]
-    
-    # 2. 視野裁切 (聚焦中心)
+# 快取是所有使用者共用的，限制筆數以免長時間執行時記憶體一直長大
+@st.cache_data(show_spinner=False, max_entries=32)
+def _decode(raw: bytes):
+    # 同一張照片只解碼一次，拉動滑桿或展開說明時不必重新解碼
+    arr = np.frombuffer(raw, np.uint8)
+    img = cv2.imdecode(arr, cv2.IMREAD_COLOR)
+    # 手機照片動輒 4000 像素，先縮到工作解析度，後面每個濾波都跟著變便宜
+    scale = _WORK_SIZE / max(img.shape[:2])
+    if scale < 1:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return img
+
+def _crop(img, scope):
+    # 視野裁切 (聚焦中心)
     # 我們不只是塗黑，而是直接切出來運算，減少運算量
+    h, w = img.shape[:2]
     crop_h, crop_w = int(h*scope), int(w*scope)
     start_y, start_x = (h - crop_h)//2, (w - crop_w)//2
-    cropped = img[start_y:start_y+crop_h, start_x:start_x+crop_w]
+    return img[start_y:start_y+crop_h, start_x:start_x+crop_w]
+
+# 每組 (照片, 視野) 都會存一張結構圖，視野滑桿有 61 個值，同樣要限制筆數
+@st.cache_data(show_spinner=False, max_entries=32)
+def _detect(raw: bytes, scope):
+    # 只回傳藥丸中心與結構圖，照片和視野沒變時整段直接用快取
+    # 快取用原始檔案位元組當 key：Streamlit 對大陣列只抽樣雜湊，兩張不同照片可能撞到同一個 key
+    # 1. 讀取 (交給 _decode，同樣有快取) + 2. 視野裁切
+    cropped = _crop(_decode(raw), scope)
+    crop_w = cropped.shape[1]
     
     # 3. 轉灰階 + 強力模糊 (去除紋路與刻痕)
     gray = cv2.cvtColor(cropped, cv2.COLOR_BGR2GRAY)
@@ -49,80 +77,78 @@ def smart_analysis(img_buffer, scope):
                                  cv2.THRESH_BINARY_INV, 25, 3)
     
     # 5. 形態學操作 (修補與斷開)
-    kernel = np.ones((3,3), np.uint8)
     # 開運算：去除小白點雜訊
-    binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, kernel, iterations=2)
+    binary = cv2.morphologyEx(binary, cv2.MORPH_OPEN, _K3, iterations=2)
     # 閉運算：把藥丸內部的空洞填滿
-    binary = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel, iterations=3)
+    binary = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, _K3, iterations=3)
+    
+    # 什麼都沒抓到 (例如鏡頭沒對準)，後面的距離變換與標記都不用做
+    if cv2.countNonZero(binary) == 0:
+        return np.empty((0, 2), np.int32), binary
     
     # 6. 距離變換 + 分水嶺 (分離沾黏)
-    dist_transform = cv2.distanceTransform(binary, cv2.DIST_L2, 5)
+    # 用 5x5 遮罩：3x3 雖然快一點，但在雜訊多的照片上核心會跟著變，顆數不穩
+    dist_transform = cv2.distanceTransform(binary, cv2.DIST_L2, cv2.DIST_MASK_5, dstType=cv2.CV_32F)
     # 這裡用較低的閾值 (0.4) 來確保不同形狀的藥丸都能找到核心
-    _, peaks = cv2.threshold(dist_transform, 0.4 * dist_transform.max(), 255, 0)
-    peaks = np.uint8(peaks)
+    # 直接比大小得到 0/1 遮罩，用 view 當成 uint8 交給標記，不必再轉型複製一次
+    peaks = (dist_transform > 0.4 * float(dist_transform.max())).view(np.uint8)
     
+    # 面積要用輪廓多邊形面積：一像素寬的細線面積是 0 會被濾掉，改用像素數就會混進來
     cnts, _ = cv2.findContours(peaks, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # moments 的 m00 就是輪廓面積 (和 cv2.contourArea 相同)，每個輪廓只呼叫一次
+    m = np.array([(M["m00"], M["m10"], M["m01"]) for M in map(cv2.moments, cnts)],
+                 np.float64).reshape(-1, 3)
     
     # === 7. 智慧過濾系統 (Smart Filter) ===
     # 這是踢掉第 5 點(瓶蓋反光)的關鍵
     
-    final_candidates = []
-    
     # 7a. 收集所有候選點的資訊
-    candidates_data = []
-    for c in cnts:
-        area = cv2.contourArea(c)
-        if area < 10: continue # 過濾極小噪點
-        
-        M = cv2.moments(c)
-        if M["m00"] != 0:
-            cX = int(M["m10"] / M["m00"])
-            cY = int(M["m01"] / M["m00"])
-            candidates_data.append({'cnt': c, 'area': area, 'center': (cX, cY)})
+    # 過濾規則全部放在陣列裡一次算完，不再一個一個點跑 Python 迴圈
+    areas = m[:, 0]
+    keep = areas >= 10 # 過濾極小噪點 (也保證 m00 不為 0)
+    centers = np.zeros((len(areas), 2), np.int32)
+    centers[keep] = (m[keep, 1:] / areas[keep, None]).astype(np.int32)
     
-    # 7b. 計算群體中位數 (大家通常多大？)
-    if candidates_data:
-        areas = [d['area'] for d in candidates_data]
-        median_area = np.median(areas)
+    if keep.any():
+        # 7b. 計算群體中位數 (大家通常多大？)
+        median_area = np.median(areas[keep])
         
         # 計算群體重心 (大家聚在哪裡？)
-        centers = np.array([d['center'] for d in candidates_data])
-        group_center = np.mean(centers, axis=0)
+        group_center = centers[keep].mean(axis=0)
+        
+        # 規則 1: 大小過濾
+        # 如果這個點比「平均大小」小太多 (例如小於 1/5)，那就是雜訊 (瓶蓋反光通常比較小)
+        keep &= areas >= median_area * 0.2
         
-        for item in candidates_data:
-            # 規則 1: 大小過濾
-            # 如果這個點比「平均大小」小太多 (例如小於 1/5)，那就是雜訊 (瓶蓋反光通常比較小)
-            if item['area'] < median_area * 0.2:
-                continue
-            
-            # 規則 2: 距離過濾
-            # 計算這個點離「大家」有多遠
-            dist_from_group = np.linalg.norm(np.array(item['center']) - group_center)
-            
-            # 如果這個點離群體的中心太遠 (大於畫面寬度的 40%)，判定為邊緣雜訊
-            if dist_from_group > crop_w * 0.4:
-                continue
-                
-            final_candidates.append(item)
-            
-    # 8. 繪圖
-    count = len(final_candidates)
+        # 規則 2: 距離過濾
+        # 如果這個點離群體的中心太遠 (大於畫面寬度的 40%)，判定為邊緣雜訊
+        # 直接比距離平方，省掉開根號
+        d2 = ((centers - group_center) ** 2).sum(axis=1)
+        keep &= d2 <= (crop_w * 0.4) ** 2
+    
+    final_centers = centers[keep]
+    return final_centers, binary
+
+def _draw(cropped, centers):
+    # 8. 繪圖 (很便宜，每次重跑都畫)
     output_img = cropped.copy()
     
-    for i, item in enumerate(final_candidates):
-        cX, cY = item['center']
-        cv2.circle(output_img, (cX, cY), 10, (0, 0, 255), -1) # 紅點
-        cv2.circle(output_img, (cX, cY), 25, (0, 255, 0), 2) # 綠圈
-        cv2.putText(output_img, str(i+1), (cX-10, cY-10), 
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.8, (255, 255, 0), 2)
+    for i, (cX, cY) in enumerate(centers.tolist()):
+        cv2.circle(output_img, (cX, cY), 10, _RED, -1) # 紅點
+        cv2.circle(output_img, (cX, cY), 25, _GREEN, 2) # 綠圈
+        cv2.putText(output_img, str(i+1), (cX-10, cY-10), _FONT, 0.8, _CYAN, 2)
+
+    return output_img
 
-    return count, output_img, binary
+def smart_analysis(raw, scope):
+    centers, binary = _detect(raw, scope)
+    return len(centers), _draw(_crop(_decode(raw), scope), centers), binary
 
 # --- 4. 執行區 ---
 img_file = st.camera_input("📸 請拍照")
 
 if img_file is not None:
-    count, result_img, debug_bin = smart_analysis(img_file, scope_size)
+    count, result_img, debug_bin = smart_analysis(img_file.getvalue(), scope_size)
     
     st.success("智慧分析完成！")
     st.markdown(f"<div style='text-align: center; font-size: 80px; font-weight: bold; color: #FFD700;'>{count} 顆</div>", unsafe_allow_html=True)